@@ -10,54 +10,84 @@ from werkzeug.routing import BaseConverter
 from trytond import __version__ as trytond_version
 from trytond.config import config
 from trytond.exceptions import ConcurrencyException, UserError, UserWarning
+from trytond.transaction import Transaction
 
 trytond_version = tuple(map(int, trytond_version.split('.')))
+_PRE_5_1 = (5, 1) > trytond_version
 __version__ = '0.11.3'
 __all__ = ['Tryton', 'tryton_transaction']
 
+_DBOpErr = None
+_WRITE_METHODS = frozenset({'PUT', 'POST', 'DELETE', 'PATCH'})
+_USER_EXCEPTIONS = (UserError, UserWarning, ConcurrencyException)
+
+
+def _get_db_op_err():
+    "Return the DatabaseOperationalError of the backend (cached)"
+    global _DBOpErr
+    if _DBOpErr is None:
+        from trytond import backend
+        _DBOpErr = (getattr(backend, 'DatabaseOperationalError', None)
+            or backend.get('DatabaseOperationalError'))
+    return _DBOpErr
+
+
+def _get_value(value):
+    return value() if callable(value) else value
+
+
+def _request_context():
+    "Return the _request context of the current request"
+    return {
+        'remote_addr': request.remote_addr,
+        'http_host': request.environ.get('HTTP_HOST'),
+        'scheme': request.scheme,
+        'is_secure': request.is_secure,
+        }
+
 
 # Start jsl patch
-from trytond.transaction import Transaction
-from contextlib import contextmanager
-@contextmanager
-def conditional_transaction_for_tests(*args, **kwargs):
+class _DummyCM(object):
+    "Context manager reusing the running transaction"
+    def __enter__(self):
+        return Transaction()
+
+    def __exit__(self, *args):
+        return False
+
+
+_DUMMY_CM = _DummyCM()
+
+
+def conditional_transaction_for_tests(
+        database, user, testing=None, **kwargs):
     """
     Start a new transaction, unless in the context of tests, and
     transaction is already running.
     """
-    need_new_transaction = (
-        not config.get('web', 'testing_flask') or
-        not Transaction().user  # test if started
-    )
-    if need_new_transaction:
-        with Transaction().start(database, user, readonly=True) as transaction:
-            yield transaction
-    else:
-        @contextmanager
-        def dummy_manager():
-            yield Transaction()
-
-        with dummy_manager() as dummy:
-            yield dummy
+    if testing is None:
+        testing = bool(config.get('web', 'testing_flask'))
+    if testing and Transaction().user:  # test if started
+        context = kwargs.get('context')
+        if context is not None:
+            return Transaction().set_context(context)
+        return _DUMMY_CM
+    return Transaction().start(database, user, **kwargs)
 # end jsl patch
 
 
-
 def retry_transaction(func):
     """Decorator to retry a transaction if failed. The decorated method
     will be run retry times in case of DatabaseOperationalError.
     """
-    from trytond import backend
-    from trytond.transaction import Transaction
-    try:
-        DatabaseOperationalError = backend.DatabaseOperationalError
-    except AttributeError:
-        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+    DatabaseOperationalError = _get_db_op_err()
 
     @wraps(func)
     def wrapper(*args, **kwargs):
         tryton = current_app.extensions['Tryton']
         retry = tryton.database_retry
+        if not retry:
+            return func(*args, **kwargs)
         for count in range(retry, -1, -1):
             try:
                 return func(*args, **kwargs)
@@ -70,6 +100,9 @@ def retry_transaction(func):
 
 class Tryton(object):
     "Control the Tryton integration to one or more Flask applications."
+    __slots__ = ('context_callback', 'database_retry', '_configure_jinja',
+        'pool', '_testing_flask')
+
     def __init__(self, app=None, configure_jinja=False):
         self.context_callback = None
         self.database_retry = None
@@ -86,11 +119,12 @@ class Tryton(object):
         config.update_etc(configfile)
 
         from trytond.pool import Pool
-        from trytond.transaction import Transaction
 
         self.database_retry = config.getint('database', 'retry')
+        self._testing_flask = bool(config.get('web', 'testing_flask'))
         self.pool = Pool(database)
-        with conditional_transaction_for_tests(database, user, readonly=True): #jsl
+        with conditional_transaction_for_tests(  # jsl
+                database, user, testing=self._testing_flask, readonly=True):
             self.pool.init()
 
         if not hasattr(app, 'extensions'):
@@ -114,13 +148,20 @@ class Tryton(object):
     @property
     def language(self):
         "Return a language instance for the current request"
-        from trytond.transaction import Transaction
         Lang = self.pool.get('ir.lang')
         # Do not use Transaction.language as it fallbacks to default language
         language = Transaction().context.get('language')
         if not language and request:
-            language = request.accept_languages.best_match(
-                Lang.get_translatable_languages())
+            accept = request.accept_languages
+            if accept:
+                languages = Lang.get_translatable_languages()
+                if (len(accept) == 1 and accept[0][1]
+                        and accept[0][0] in languages):
+                    language = accept[0][0]
+                else:
+                    language = accept.best_match(languages)
+            else:
+                language = None
         return Lang.get(language)
 
     def format_date(self, value, lang=None, *args, **kwargs):
@@ -152,8 +193,7 @@ class Tryton(object):
             value, converter=converter, lang=lang, *args, **kwargs)
 
     def _readonly(self):
-        return not (request
-            and request.method in ('PUT', 'POST', 'DELETE', 'PATCH'))
+        return not (request and request.method in _WRITE_METHODS)
 
     @staticmethod
     def transaction(readonly=None, user=None, context=None):
@@ -168,87 +208,72 @@ class Tryton(object):
 
         readonly, user and context can also be callable.
         """
-        from trytond import backend
         from trytond.cache import Cache
-        from trytond.transaction import Transaction
-        try:
-            DatabaseOperationalError = backend.DatabaseOperationalError
-        except AttributeError:
-            DatabaseOperationalError = backend.get('DatabaseOperationalError')
-
-        def get_value(value):
-            return value() if callable(value) else value
-
-        def instanciate(value):
-            if isinstance(value, _BaseProxy):
-                return value()
-            return value
+        from trytond.worker import run_task
 
         def decorator(func):
             @retry_transaction
             @wraps(func)
             def wrapper(*args, **kwargs):
                 tryton = current_app.extensions['Tryton']
-                database = current_app.config['TRYTON_DATABASE']
-                if (5, 1) > trytond_version:
-                    #jsl
-                    with conditional_transaction_for_tests(database, 0):
-                        Cache.clean(database)
+                app_config = current_app.config
+                database = app_config['TRYTON_DATABASE']
+                legacy = _PRE_5_1
                 if user is None:
-                    transaction_user = get_value(
-                        int(current_app.config['TRYTON_USER']))
+                    transaction_user = int(app_config['TRYTON_USER'])
                 else:
-                    transaction_user = get_value(user)
+                    transaction_user = _get_value(user)
 
                 if readonly is None:
-                    is_readonly = get_value(tryton._readonly)
+                    is_readonly = _get_value(tryton._readonly)
                 else:
-                    is_readonly = get_value(readonly)
+                    is_readonly = _get_value(readonly)
 
-                transaction_context = {}
                 if tryton.context_callback or context:
-                    #jsl
-                    with conditional_transaction_for_tests(
-                        database, transaction_user, readonly=True
-                    ):
-                        if tryton.context_callback:
-                            transaction_context = tryton.context_callback()
-                        transaction_context.update(get_value(context) or {})
-
-                transaction_context.setdefault('_request', {}).update({
-                        'remote_addr': request.remote_addr,
-                        'http_host': request.environ.get('HTTP_HOST'),
-                        'scheme': request.scheme,
-                        'is_secure': request.is_secure,
-                        } if request else {})
+                    # The default context is set inside the transaction
+                    transaction_context = {}
+                elif request:
+                    transaction_context = {'_request': _request_context()}
+                else:
+                    transaction_context = {'_request': {}}
 
-                #jsl
+                # jsl
                 with conditional_transaction_for_tests(
-                    database, transaction_user, readonly=is_readonly,
+                    database, transaction_user,
+                    testing=tryton._testing_flask, readonly=is_readonly,
                     context=transaction_context
                 ) as transaction:
+                    if legacy:
+                        Cache.clean(database)
+                    if tryton.context_callback or context:
+                        if tryton.context_callback:
+                            transaction_context = tryton.context_callback()
+                        transaction_context.update(_get_value(context) or {})
+                        request_context = transaction_context.setdefault(
+                            '_request', {})
+                        if request:
+                            request_context.update(_request_context())
+                        # The previous context is restored when leaving the
+                        # transaction or the reused one in testing mode
+                        transaction.set_context(transaction_context)
                     try:
-                        result = func(*map(instanciate, args),
-                            **dict((n, instanciate(v))
-                                for n, v in kwargs.items()))
+                        result = func(
+                            *[a() if isinstance(a, _BaseProxy) else a
+                                for a in args],
+                            **{n: v() if isinstance(v, _BaseProxy) else v
+                                for n, v in kwargs.items()})
                         if (hasattr(transaction, 'cursor')
                                 and not is_readonly):
                             transaction.cursor.commit()
-                    except DatabaseOperationalError:
-                        raise
-                    except Exception as e:
-                        if isinstance(e, (
-                                    UserError,
-                                    UserWarning,
-                                    ConcurrencyException)):
-                            raise BadRequest(e.message)
-                        raise
-                    if (5, 1) > trytond_version:
+                    except _USER_EXCEPTIONS as e:
+                        raise BadRequest(e.message)
+                    if legacy:
                         Cache.resets(database)
-                from trytond.worker import run_task
-                while transaction.tasks:
-                    task_id = transaction.tasks.pop()
-                    run_task(tryton.pool, task_id)
+                tasks = transaction.tasks
+                if tasks:
+                    pool = tryton.pool
+                    while tasks:
+                        run_task(pool, tasks.pop())
                 return result
             return wrapper
         return decorator
@@ -258,14 +283,24 @@ tryton_transaction = Tryton.transaction
 
 
 class _BaseProxy(object):
-    pass
+    __slots__ = ()
 
 
 class _RecordsProxy(_BaseProxy):
+    __slots__ = ('model', 'ids')
+
     def __init__(self, model, ids):
         self.model = model
         self.ids = list(ids)
 
+    @classmethod
+    def _from_ids(cls, model, ids):
+        "Create a proxy taking ownership of the ids list without copy"
+        proxy = cls.__new__(cls)
+        proxy.model = model
+        proxy.ids = ids
+        return proxy
+
     def __iter__(self):
         return iter(self.ids)
 
@@ -276,6 +311,8 @@ class _RecordsProxy(_BaseProxy):
 
 
 class _RecordProxy(_RecordsProxy):
+    __slots__ = ()
+
     def __init__(self, model, id):
         super(_RecordProxy, self).__init__(model, [id])
 
@@ -283,7 +320,9 @@ class _RecordProxy(_RecordsProxy):
         return self.ids[0]
 
     def __call__(self):
-        return super(_RecordProxy, self).__call__()[0]
+        tryton = current_app.extensions['Tryton']
+        Model = tryton.pool.get(self.model)
+        return Model(self.ids[0])
 
 
 class RecordConverter(BaseConverter):
@@ -300,6 +339,10 @@ class RecordConverter(BaseConverter):
         return _RecordProxy(self.model, int(value))
 
     def to_url(self, value):
+        if isinstance(value, _RecordProxy):
+            return str(value.ids[0])
+        elif type(value) is int:
+            return str(value)
         return str(int(value))
 
 
@@ -314,7 +357,10 @@ class RecordsConverter(BaseConverter):
         self.model = model
 
     def to_python(self, value):
-        return _RecordsProxy(self.model, map(int, value.split(',')))
+        return _RecordsProxy._from_ids(
+            self.model, [int(x) for x in value.split(',')])
 
     def to_url(self, value):
+        if isinstance(value, _RecordsProxy):
+            return ','.join(map(str, value.ids))
         return ','.join(map(str, map(int, value)))